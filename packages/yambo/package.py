@@ -3,10 +3,209 @@
 #
 # SPDX-License-Identifier: (Apache-2.0 OR MIT)
 import os
-from pathlib import Path
+import re
+import shutil
 
 from spack import *
 
+# MKL link lines, keyed on (compiler family, +openmp)
+_MKL_LIBS = {
+    ('intel', False): '-lmkl_intel_lp64 -lmkl_sequential -lmkl_core',
+    ('intel', True): '-lmkl_intel_lp64 -lmkl_intel_thread -lmkl_core -liomp5',
+    ('oneapi', False): '-lmkl_intel_lp64 -lmkl_sequential -lmkl_core',
+    ('oneapi', True): '-lmkl_intel_lp64 -lmkl_intel_thread -lmkl_core -liomp5',
+    ('gcc', False): '-Wl,--no-as-needed -lmkl_gf_lp64 -lmkl_sequential -lmkl_core',
+    ('gcc', True): '-lmkl_gf_lp64 -lmkl_gnu_thread -lmkl_core -lgomp',
+    ('nvhpc', False): '-lmkl_intel_lp64 -lmkl_sequential -lmkl_core',
+    ('nvhpc', True): '-lmkl_intel_lp64 -lmkl_pgi_thread -lmkl_core -pgf90libs -mp',
+}
+
+
+def _compile(*substitutions):
+    """Compile (regex, replacement) pairs for use with _apply_patterns."""
+    return tuple((re.compile(regex), repl) for regex, repl in substitutions)
+
+
+def _apply_patterns(filename, patterns):
+    """Apply (compiled regex, replacement) pairs to a file in a single
+    read/write pass. The file is left untouched if nothing matched."""
+    with open(filename, errors='surrogateescape') as f:
+        original = f.read()
+    text = original
+    for pattern, repl in patterns:
+        text = pattern.sub(repl, text)
+    if text != original:
+        with open(filename, 'w', errors='surrogateescape') as f:
+            f.write(text)
+
+
+# Source substitutions applied by the run_before('configure') filters
+_ARCHIVE_IOTK_PATTERNS = _compile(
+    # block iotk download
+    (r'; \$\(getsrc\)', ' '),
+)
+_IOTK_LEGACY_PATTERNS = _compile(
+    (r'\( cd \.\./archive ;', '#( cd ../archive ;'),
+    (r'; \$\(make\) \$\(TARBALL\) ; fi \)', '; #$(make) $(TARBALL) ; fi )'),
+    (r'gunzip', '#gunzip'),
+)
+_IOTK_PATTERNS = _compile(
+    # set link for iotk lib dir and block tarball uncompress
+    (r'! test -d iotk;', ' test -d iotk;'),
+    (r'@\$\(uncompress\)', 'touch uncompress.stamp'),
+)
+_YDRIVER_LEGACY_MAKE_PATTERNS = _compile(
+    # solve issue for parallel compilation
+    (r'\$\(MAKE\) \$\(MAKEFLAGS\) -f Makefile.loc', '$(MAKE) -f Makefile.loc $(MAKEFLAGS)'),
+)
+_YDRIVER_LEGACY_ARCHIVE_PATTERNS = _compile(
+    # block Ydriver download
+    (r'; \$\(getsrc_git\); \$\(call link_it,"yambo"\)', ' '),
+)
+_YDRIVER_ARCHIVE_PATTERNS = _compile(
+    # block Ydriver download
+    (r'; \$\(call getsrc_git,"Ydriver"\); \$\(call copy_driver,"Ydriver"\)', ' '),
+)
+_REPORT_PATTERN = re.compile(r'cat config/report')
+_CONFIGURE_PATTERNS = _compile(
+    # fix petsc bad recognition
+    (r'#include <petsc/finclude/petscvec\.h90>', '#include <petsc/finclude/petscvec.h>'),
+    # fix hdf5 bad linking and include flags
+    (r'.+try_HDF5_LIBS=..h5pfc -show .+', '#'),
+    (r'.+try_hdf5_incdir=..h5pfc -show .+', '#'),
+    (r'.+try_HDF5_LIBS=..h5fc -show .+', '#'),
+    (r'.+try_hdf5_incdir=..h5fc -show .+', '#'),
+)
+_LIBRARIES_PATTERNS = _compile(
+    # fix petsc linking issue
+    (r'libs="-lint_modules \$libs \$llocal \$lPLA \$lIO \$lextlibs -lm"',
+     'libs="-lint_modules $libs $llocal $lSL $lPLA $lIO $lextlibs -lm"'),
+    (r'libs="\$libs \$llocal \$lPLA \$lIO \$lextlibs -lm"',
+     'libs="$libs $llocal $lSL $lPLA $lIO $lextlibs -lm"'),
+)
+_ONEAPI_CONFIGURE_PATTERNS = _compile(
+    (r'\*ifort\*', '*ifx*'),
+    (r'2021', '2023'),
+)
+_ONEAPI_IOTK_PATTERNS = _compile(
+    (r'FC="\$\(fc\)"', 'FC=mpiifort'),
+)
+_ONEAPI_YDRIVER_PATTERNS = _compile(
+    (r'#include <stdlib\.h>',
+     '#if defined _ypp || defined _a2y || defined _p2y || defined _c2y || defined _e2y || defined _eph2y\n'
+     ' #include <yambo_driver.h>\n'
+     '#endif'),
+)
+
+# Ydriver tarballs, one per range of Yambo versions; releases from 1.2.0
+# share the same layout under lib/yambo/Ydriver
+_YDRIVER_PLACEMENT = {
+    'config': 'config',
+    'configure': 'configure',
+    'example': 'example',
+    'include': 'include',
+    'lib': 'lib',
+    'bin': 'bin',
+    'Makefile': 'Makefile',
+    'src': 'src',
+}
+_YDRIVER_RESOURCES = (
+    dict(url='https://github.com/yambo-code/yambo-libraries/raw/master/external/Ydriver-0.0.2.tar.gz',
+         sha256='63984c3eb2d28320b320f1d9b3a2c1efcd3c9505a10d887c8bbd54513442202c',
+         destination='',
+         placement={'driver': 'lib/yambo/driver'},
+         when='@5.0.0:5.0.99'),
+    dict(url='https://github.com/yambo-code/yambo-libraries/raw/master/external/Ydriver-1.1.0.tar.gz',
+         sha256='6c316d613f5a41ddd15efad7ba97e4712f87d7e56c073ba5458caf424afcb97a',
+         destination='',
+         placement={'driver': 'lib/yambo/driver'},
+         when='@5.1.0:5.1.99'),
+    dict(url='https://github.com/yambo-code/Ydriver/archive/refs/tags/1.2.0.tar.gz',
+         sha256='0f29a44e9c4b49d3f6be3f159a7ef415932b2ae2f2fdba163af60a0673befe6e',
+         destination='lib/yambo/Ydriver',
+         placement=_YDRIVER_PLACEMENT,
+         when='@5.2.0:5.2.99'),
+    dict(url='https://github.com/yambo-code/Ydriver/archive/refs/tags/1.2.0.tar.gz',
+         sha256='0f29a44e9c4b49d3f6be3f159a7ef415932b2ae2f2fdba163af60a0673befe6e',
+         destination='lib/yambo/Ydriver',
+         placement=_YDRIVER_PLACEMENT,
+         when='@develop-bareh'),
+    dict(url='https://github.com/yambo-code/Ydriver/archive/refs/tags/1.4.tar.gz',
+         sha256='a3ac8de158fcd76cfb7c137f7096cff2d95eb9db2fe207d54476c73013f1406e',
+         destination='lib/yambo/Ydriver',
+         placement=_YDRIVER_PLACEMENT,
+         when='@develop-develop'),
+)
+
+# Intel MPI wrappers exported to Yambo's configure, keyed on (MPI provider,
+# compiler family); other providers use the wrappers Spack sets on spec['mpi']
+_INTEL_CLASSIC_WRAPPERS = {'MPICC': 'mpiicc', 'MPICXX': 'mpiicpc', 'MPIF77': 'mpiifort', 'MPIFC': 'mpiifort'}
+_INTEL_LLVM_WRAPPERS = {'MPICC': 'mpiicx', 'MPIF77': 'mpiifx', 'MPIFC': 'mpiifx'}
+_MPI_WRAPPERS = {
+    ('intel-mpi', 'intel'): _INTEL_CLASSIC_WRAPPERS,
+    ('intel-mpi', 'oneapi'): _INTEL_LLVM_WRAPPERS,
+    ('intel-oneapi-mpi', 'intel'): _INTEL_CLASSIC_WRAPPERS,
+    ('intel-oneapi-mpi', 'oneapi'): _INTEL_LLVM_WRAPPERS,
+    ('intel-parallel-studio', 'intel'): _INTEL_CLASSIC_WRAPPERS,
+    ('intel-parallel-studio', 'oneapi'): _INTEL_LLVM_WRAPPERS,
+}
+
+# Compiler and preprocessor settings exported to Yambo's configure, keyed on
+# the compiler family
+_COMPILER_ENV = {
+    'nvhpc': {
+        'FC': "nvfortran",
+        'CPP': "cpp -E",
+        'FPP': "nvfortran -Mpreprocess -E",
+        'F90SUFFIX': ".f90",
+    },
+    'intel': {
+        'FPP': "ifort -E -free -P",
+        'FC': "ifort",
+        'F77': "ifort",
+        'CC': "icc",
+        'CPP': "icc -E -ansi",
+    },
+    'oneapi': {
+        'FC': "ifx",
+        'F77': "ifx",
+        'CC': "icx",
+        'FPP': "ifx -E -free -P",
+        'CPP': "icx -E -ansi",
+    },
+}
+
+# Host-specific optimization flags for the native variant, keyed on the
+# compiler family
+_NATIVE_FLAGS = {
+    'gcc': ('-O3', '-march=native', '-funroll-loops'),
+    'intel': ('-O3', '-xHost'),
+    'oneapi': ('-O3', '-xHost'),
+    'nvhpc': ('-fast',),
+}
+
+# MPI-IO hints installed for the mpiio_hints variant, one "key value" per line
+_MPIIO_HINTS = {
+    'gpfs': (
+        ('IBM_largeblock_io', 'true'),
+        ('cb_buffer_size', '16777216'),
+        ('romio_cb_write', 'enable'),
+    ),
+    'lustre': (
+        ('striping_unit', '4194304'),
+        ('cb_buffer_size', '16777216'),
+        ('romio_cb_write', 'enable'),
+    ),
+}
+
+# Variants whose configure option does not follow the variant name
+_CONFIGURE_FLAGS = {
+    'time': 'time-profile',
+    'memory': 'memory-profile',
+    'openmp': 'open-mp',
+    'parallel_io': 'hdf5-par-io',
+}
+
 
 class Yambo(AutotoolsPackage,CudaPackage,ROCmPackage):
     """YAMBO is an open-source code released within the GPL licence.
@@ -60,6 +259,11 @@ class Yambo(AutotoolsPackage,CudaPackage,ROCmPackage):
     # MPI + OpenMP parallelism
     variant('mpi', default=True, description='Enable MPI support')
     variant('openmp', default=False, description='Enable OpenMP support')
+    variant('threaded_fft', default=False, when='+openmp',
+            description='Link threaded FFTW when FFTW, not MKL, supplies the FFT '
+                        '(often slower when BLAS threading is also on)')
+    conflicts('+threaded_fft', when='^mkl',
+              msg="With MKL the FFT comes from MKL and follows +openmp")
     depends_on('mpi', when='+mpi')
 
     conflicts('+scalapack', when='~mpi',
@@ -69,18 +273,21 @@ class Yambo(AutotoolsPackage,CudaPackage,ROCmPackage):
     variant('scalapack', default=False, description='Activate support for parallel linear algebra with SCALAPACK')
     depends_on('scalapack', when='+scalapack')
     variant('slepc', default=False, description='Activate support for linear algebra with SLEPc and PETSc')
-    depends_on('petsc+complex~superlu-dist~hypre~metis+int64', when='+slepc')
-    depends_on('petsc+mpi', when='+slepc+mpi')
-    depends_on('petsc+double', when='+slepc+dp')
-    depends_on('petsc~cuda', when='@:5.2.0 +slepc')
-    depends_on('slepc~arpack', when='+slepc')
-    depends_on('slepc@:3.7.4', when='@:4.5.3 +slepc')
-    depends_on('slepc~cuda', when='@:5.2.0 +slepc')
+    with when('+slepc'):
+        depends_on('petsc+complex~superlu-dist~hypre~metis+int64')
+        depends_on('petsc+mpi', when='+mpi')
+        depends_on('petsc+double', when='+dp')
+        depends_on('petsc~cuda', when='@:5.2.0')
+        depends_on('slepc~arpack')
+        depends_on('slepc@:3.7.4', when='@:4.5.3')
+        depends_on('slepc~cuda', when='@:5.2.0')
     
     variant('openmp5', default=False, description='Build with OpenMP-GPU support')
     variant('openacc', default=False, description='Build with OpenACC')
     variant('cuda-fortran', default=False, description='Build with CUDA-Fortran')
     with when('+cuda-fortran'):
+        conflicts('~cuda',
+                  msg="CUDA-Fortran requires +cuda to select the CUDA toolkit")
         conflicts('cuda_arch=none',
                   msg="CUDA architecture is required when +cuda")
         conflicts('@:4.5.3',
@@ -93,6 +300,15 @@ class Yambo(AutotoolsPackage,CudaPackage,ROCmPackage):
                   msg="CUDA-Fortran available only with NV or PGI compilers")
     variant('nvtx', default=False, description='Enable NVTX support', when='+cuda %nvhpc')
     variant('magma', default=False, description='Enable Magma support', when='+cuda %nvhpc')
+    variant('cuda-aware-mpi', default=False, when='+cuda +mpi',
+            description='Build Open MPI, MPICH or MVAPICH2 with CUDA support so device buffers are not staged through the host')
+    with when('+cuda-aware-mpi'):
+        depends_on('openmpi+cuda', when='^openmpi')
+        depends_on('mpich+cuda', when='^mpich')
+        depends_on('mvapich2+cuda', when='^mvapich2')
+        for _mpi in ('intel-mpi', 'intel-oneapi-mpi', 'intel-parallel-studio'):
+            conflicts('^' + _mpi, msg="{0} cannot be built CUDA-aware".format(_mpi))
+        del _mpi
     depends_on('magma+cuda', when='+magma')
     with when('@develop-gpu'):
         depends_on('devicexlib+cuda-fortran+cuda', when='+cuda-fortran+cuda %nvhpc')
@@ -100,6 +316,7 @@ class Yambo(AutotoolsPackage,CudaPackage,ROCmPackage):
     
     # Other variants
     variant('dp', default=False, description='Enable double precision')
+    variant('native', default=False, description='Optimize for the CPU of the build host')
     variant('time', default=False, description='Activate time profiling of specific sections')
     variant('memory', default=False, description='Activate memory profiling of specific sections')
     variant('ph', default=False, description='Compile Electron-phonon coupling project executables: yambo_ph ypp_ph')
@@ -107,16 +324,17 @@ class Yambo(AutotoolsPackage,CudaPackage,ROCmPackage):
     variant('sc', default=False, description='Compile Self-consistent (COHSEX, HF, DFT) project executables: yambo_sc ypp_sc')
     variant('nl', default=False, description='Compile Non-linear optics project executables: yambo_nl ypp_nl')
 
-    # Yambopy
-    # variant('yambopy', default=False, description='Install Yambopy package')
-    # depends_on('py-yambopy', when='+yambopy')
-
     # FFTW
     depends_on('fftw-api@3~mpi', when='~mpi')
     depends_on('fftw-api@3+mpi', when='+mpi')
 
     # HDF5
     variant('parallel_io', default=True, when='@4.4.0: +mpi', description='Activate the HDF5 parallel I/O')
+    variant('mpiio_hints', default='none', values=('none', 'gpfs', 'lustre'), when='+parallel_io',
+            description='Install ROMIO hints tuned for the given filesystem and export ROMIO_HINTS at runtime')
+    # parallel_io only exists for @4.4.0: +mpi and '~parallel_io' does not
+    # match specs where the variant is undefined, so the serial builds for
+    # older versions and ~mpi must be requested separately
     depends_on('hdf5+fortran+hl~mpi', when='@:4.4.0')
     depends_on('hdf5+fortran+hl~mpi', when='~parallel_io')
     depends_on('hdf5+fortran+hl+mpi', when='+parallel_io')
@@ -135,7 +353,10 @@ class Yambo(AutotoolsPackage,CudaPackage,ROCmPackage):
     with when("+openmp"):
         depends_on("openblas threads=openmp", when="^openblas")
         depends_on("intel-oneapi-mkl threads=openmp", when="^intel-oneapi-mkl")
-        depends_on("fftw +openmp", when="^fftw")
+        depends_on("fftw +openmp", when="+threaded_fft ^fftw")
+        # configure links fftw3_omp whenever FFTW provides it; with MKL the
+        # FFT comes from the MKL link line and this FFTW is not linked
+        depends_on("fftw ~openmp", when="~threaded_fft ^fftw")
         depends_on("petsc +openmp", when="^petsc")
 
     # IOTK
@@ -147,70 +368,9 @@ class Yambo(AutotoolsPackage,CudaPackage,ROCmPackage):
     )
 
     # Yambo driver
-    resource(
-       name='Ydriver',
-       url='https://github.com/yambo-code/yambo-libraries/raw/master/external/Ydriver-0.0.2.tar.gz',
-       sha256='63984c3eb2d28320b320f1d9b3a2c1efcd3c9505a10d887c8bbd54513442202c',
-       destination='',
-       placement={'driver': 'lib/yambo/driver'},
-       when='@5.0.0:5.0.99'
-    )
-    resource(
-       name='Ydriver',
-       url='https://github.com/yambo-code/yambo-libraries/raw/master/external/Ydriver-1.1.0.tar.gz',
-       sha256='6c316d613f5a41ddd15efad7ba97e4712f87d7e56c073ba5458caf424afcb97a',
-       destination='',
-       placement={'driver': 'lib/yambo/driver'},
-       when='@5.1.0:5.1.99'
-    )
-    resource(
-       name='Ydriver',
-       url='https://github.com/yambo-code/Ydriver/archive/refs/tags/1.2.0.tar.gz',
-       sha256='0f29a44e9c4b49d3f6be3f159a7ef415932b2ae2f2fdba163af60a0673befe6e',
-       destination='lib/yambo/Ydriver',
-       placement={'config': 'config',
-                  'configure': 'configure',
-                  'example': 'example',
-                  'include': 'include',
-                  'lib': 'lib',
-                  'bin': 'bin',
-                  'Makefile': 'Makefile',
-                  'src': 'src',
-              },
-       when='@5.2.0:5.2.99'
-    )
-    resource(
-       name='Ydriver',
-       url='https://github.com/yambo-code/Ydriver/archive/refs/tags/1.2.0.tar.gz',
-       sha256='0f29a44e9c4b49d3f6be3f159a7ef415932b2ae2f2fdba163af60a0673befe6e',
-       destination='lib/yambo/Ydriver',
-       placement={'config': 'config',
-                  'configure': 'configure',
-                  'example': 'example',
-                  'include': 'include',
-                  'lib': 'lib',
-                  'bin': 'bin',
-                  'Makefile': 'Makefile',
-                  'src': 'src',
-              },
-       when='@develop-bareh'
-    )
-    resource(
-       name='Ydriver',
-       url='https://github.com/yambo-code/Ydriver/archive/refs/tags/1.4.tar.gz',
-       sha256='a3ac8de158fcd76cfb7c137f7096cff2d95eb9db2fe207d54476c73013f1406e',
-       destination='lib/yambo/Ydriver',
-       placement={'config': 'config',
-                  'configure': 'configure',
-                  'example': 'example',
-                  'include': 'include',
-                  'lib': 'lib',
-                  'bin': 'bin',
-                  'Makefile': 'Makefile',
-                  'src': 'src',
-              },
-       when='@develop-develop'
-    )
+    for _ydriver in _YDRIVER_RESOURCES:
+        resource(name='Ydriver', **_ydriver)
+    del _ydriver
 
     # Sanity check
     sanity_check_is_file = ["bin/yambo", "bin/ypp", "bin/a2y", "bin/c2y", "bin/p2y"]
@@ -218,46 +378,28 @@ class Yambo(AutotoolsPackage,CudaPackage,ROCmPackage):
     @property
     def build_targets(self):
         spec = self.spec
-        if '+ph' in spec and '+rt' in spec and '+sc' in spec and '+nl' in spec:
+        projects = [p for p in ('ph', 'rt', 'sc', 'nl') if '+' + p in spec]
+        if len(projects) == 4:
             return ['all']
-        bt = ['core']
-        if '+ph' in spec:
-            bt.append('ph-project')
-        if '+rt' in spec:
-            bt.append('rt-project')
-        if '+sc' in spec:
-            bt.append('sc-project')
-        if '+nl' in spec:
-            bt.append('nl-project')
-        return bt
+        return ['core'] + ['{0}-project'.format(p) for p in projects]
 
     @run_before('configure')
     def filter_iotk(self):
-        # block iotk download
-        filter_file('; \$\(getsrc\)', ' ', 'lib/archive/Makefile.loc')
-        # filter_file('783147', '962173', 'lib/archive/Makefile.loc', when='@:4.5.0')
-        with when('@:5.0.99'):
-            filter_file('\( cd \.\./archive ;', r'#( cd ../archive ;', 'lib/iotk/Makefile.loc')
-            filter_file('; \$\(make\) \$\(TARBALL\) ; fi \)', r'; #$(make) $(TARBALL) ; fi )', 'lib/iotk/Makefile.loc')
-            filter_file('gunzip', r'#gunzip', 'lib/iotk/Makefile.loc')
-        with when('@5.1.1:'):
-            # set link for iotk lib dir and block tarball uncompress
-            filter_file('! test -d iotk;', ' test -d iotk;', 'lib/iotk/Makefile.loc')
-            filter_file('@\$\(uncompress\)', 'touch uncompress.stamp', 'lib/iotk/Makefile.loc')
+        spec = self.spec
+        _apply_patterns('lib/archive/Makefile.loc', _ARCHIVE_IOTK_PATTERNS)
+        if spec.satisfies('@:5.0.99'):
+            _apply_patterns('lib/iotk/Makefile.loc', _IOTK_LEGACY_PATTERNS)
+        if spec.satisfies('@5.1.1:'):
+            _apply_patterns('lib/iotk/Makefile.loc', _IOTK_PATTERNS)
 
     @run_before('configure')
     def filter_ydriver(self):
         spec = self.spec
-        if '@5.1.0:5.1.99' in spec or '@develop-pcm' in spec:
-            # solve issue for parallel compilation
-            filter_file('\$\(MAKE\) \$\(MAKEFLAGS\) -f Makefile.loc', 
-                        r'$(MAKE) -f Makefile.loc $(MAKEFLAGS)', 
-                        'config/mk/global/functions/get_libraries.mk')
-            # block Ydriver download
-            filter_file('; \$\(getsrc_git\); \$\(call link_it,"yambo"\)', ' ', 'lib/archive/Makefile.loc')
+        if '@5.1.0:5.1.99' in spec:
+            _apply_patterns('config/mk/global/functions/get_libraries.mk', _YDRIVER_LEGACY_MAKE_PATTERNS)
+            _apply_patterns('lib/archive/Makefile.loc', _YDRIVER_LEGACY_ARCHIVE_PATTERNS)
         if '@5.2.0:' in spec:
-            # block Ydriver download
-            filter_file('; \$\(call getsrc_git,"Ydriver"\); \$\(call copy_driver,"Ydriver"\)', ' ', 'lib/archive/Makefile.loc')
+            _apply_patterns('lib/archive/Makefile.loc', _YDRIVER_ARCHIVE_PATTERNS)
 
     @run_before('configure')
     def filter_configure(self):
@@ -265,81 +407,72 @@ class Yambo(AutotoolsPackage,CudaPackage,ROCmPackage):
         # The configure in the package has the string 'cat config/report'
         # hard-coded, which causes a failure at configure time due to the
         # current working directory in Spack. Fix this by using the absolute
-        # path to the file.
-        report_abspath = join_path(self.build_directory, 'config', 'report')
-        filter_file('cat config/report', 'cat '+report_abspath, 'configure')
-        # fix petsc bad recognition
-        filter_file('#include <petsc/finclude/petscvec.h90>', '#include <petsc/finclude/petscvec.h>', 'configure')
-        # fix hdf5 bad linking and include flags
-        filter_file('.+try_HDF5_LIBS=..h5pfc -show .+', '#', 'configure')
-        filter_file('.+try_hdf5_incdir=..h5pfc -show .+', '#', 'configure')
-        filter_file('.+try_HDF5_LIBS=..h5fc -show .+', '#', 'configure')
-        filter_file('.+try_hdf5_incdir=..h5fc -show .+', '#', 'configure')
+        # path to the file. The replacement is a callable so that the path is
+        # inserted literally, not parsed as a re template.
+        report = 'cat ' + join_path(self.build_directory, 'config', 'report')
+        _apply_patterns('configure', ((_REPORT_PATTERN, lambda _: report),) + _CONFIGURE_PATTERNS)
         if '@5.1.2:' in spec:
-            # fix petsc linking issue
-            filter_file('libs="-lint_modules \$libs \$llocal \$lPLA \$lIO \$lextlibs -lm"', 
-                        r'libs="-lint_modules $libs $llocal $lSL $lPLA $lIO $lextlibs -lm"', 
-                        'sbin/compilation/libraries.sh')
-            filter_file('libs="\$libs \$llocal \$lPLA \$lIO \$lextlibs -lm"', 
-                        r'libs="$libs $llocal $lSL $lPLA $lIO $lextlibs -lm"', 
-                        'sbin/compilation/libraries.sh')
+            _apply_patterns('sbin/compilation/libraries.sh', _LIBRARIES_PATTERNS)
 
     @run_before('configure')
     def filter_oneapi(self):
         # fix oneapi ifx issues
         spec = self.spec
         if '%oneapi' in spec and '@5.0.0:5.2.99' in spec:
-            filter_file('\*ifort\*', '*ifx*', 'configure')
-            filter_file('2021', '2023', 'configure')
-            filter_file('FC="\$\(fc\)"', 'FC=mpiifort', 'lib/iotk/Makefile.loc')
-            filter_file('#include \<stdlib.h\>', '#if defined _ypp || defined _a2y || defined _p2y || defined _c2y || defined _e2y || defined _eph2y\n #include <yambo_driver.h>\n#endif', 'lib/yambo/Ydriver/src/main/options_maker.c')
-
-    def enable_or_disable_time(self, activated):
-        return '--enable-time-profile' if activated else '--disable-time-profile'
-
-    def enable_or_disable_memory(self, activated):
-        return '--enable-memory-profile' if activated else '--disable-memory-profile'
-
-    def enable_or_disable_openmp(self, activated):
-        return '--enable-open-mp' if activated else '--disable-open-mp'
-
-    def enable_or_disable_parallel_io(self, activated):
-        return '--enable-hdf5-par-io' if activated else '--disable-hdf5-par-io'
+            _apply_patterns('configure', _ONEAPI_CONFIGURE_PATTERNS)
+            _apply_patterns('lib/iotk/Makefile.loc', _ONEAPI_IOTK_PATTERNS)
+            _apply_patterns('lib/yambo/Ydriver/src/main/options_maker.c', _ONEAPI_YDRIVER_PATTERNS)
+
+    def enable_or_disable(self, name, activation_value=None, variant=None):
+        flag = _CONFIGURE_FLAGS.get(name)
+        if flag is None or activation_value is not None or variant is not None:
+            return super().enable_or_disable(name, activation_value, variant)
+        if name not in self.spec.variants:
+            return []
+        activated = self.spec.variants[name].value
+        return ['--{0}-{1}'.format('enable' if activated else 'disable', flag)]
+
+    def _compiler_family(self):
+        """Return the compiler family keying the per-compiler-family tables."""
+        for family in ('intel', 'oneapi', 'gcc', 'nvhpc'):
+            if '%' + family in self.spec:
+                return family
+        return None
+
+    def flag_handler(self, name, flags):
+        if name in ('cflags', 'fflags') and '+native' in self.spec:
+            flags.extend(_NATIVE_FLAGS.get(self._compiler_family(), ()))
+        return (flags, None, None)
 
     def setup_build_environment(self, env):
         spec = self.spec
-        if spec['mpi'].name == 'openmpi':
-            env.set('MPICC', 'mpicc')
-            env.set('MPICXX', 'mpicxx')
-            env.set('MPIF77', 'mpif77')
-            env.set('MPIFC', 'mpif90')
-        if '%nvhpc' in spec:
-            env.set('FC', "nvfortran")
-            env.set('CPP', "cpp -E")
-            env.set('FPP', "nvfortran -Mpreprocess -E")
-            env.set('F90SUFFIX', ".f90")
+        family = self._compiler_family()
+        # MPI wrappers and compiler settings set disjoint variables
+        mods = dict(_COMPILER_ENV.get(family, {}))
+        if '+mpi' in spec:
+            mpi = spec['mpi']
+            mods.update(_MPI_WRAPPERS.get((mpi.name, family), {
+                'MPICC': mpi.mpicc,
+                'MPICXX': mpi.mpicxx,
+                'MPIF77': mpi.mpif77,
+                'MPIFC': mpi.mpifc,
+            }))
+        for var, value in mods.items():
+            env.set(var, value)
+        if family == 'nvhpc':
             env.unset('CUDA_HOME')
-        if '%intel' in spec:
-            env.set('FPP', "ifort -E -free -P")
-            env.set('FC', "ifort")
-            env.set('F77', "ifort")
-            env.set('CC', "icc")
-            env.set('CPP', "icc -E -ansi")
-            if 'intel' in spec['mpi'].name:
-                env.set('MPICC', 'mpiicc')
-                env.set('MPICXX', 'mpiicpc')
-                env.set('MPIF77', 'mpiifort')
-                env.set('MPIFC', 'mpiifort')
-        if '%oneapi' in spec:
-            env.set('FC', "ifx")
-            env.set('F77', "ifx")
-            env.set('CC', "icx")
-            env.set('FPP', "ifx -E -free -P")
-            env.set('CPP', "icx -E -ansi")
-            if 'intel' in spec['mpi'].name:
-                env.set('MPICC', 'mpiicx')
-                env.set('MPIF77', 'mpiifx')
-                env.set('MPIFC', 'mpiifx')
+
+    @property
+    def romio_hints(self):
+        """Path of the installed ROMIO hints file, or None if not requested."""
+        hints = self.spec.variants.get('mpiio_hints')
+        if hints is None or hints.value == 'none':
+            return None
+        return join_path(self.prefix.etc, 'romio_hints')
+
+    def setup_run_environment(self, env):
+        if self.romio_hints:
+            env.set('ROMIO_HINTS', self.romio_hints)
 
     def configure_args(self):
         spec = self.spec
@@ -348,56 +481,47 @@ class Yambo(AutotoolsPackage,CudaPackage,ROCmPackage):
             '--enable-msgs-comps',
             '--disable-keep-objects',
             '--with-editor=none',
-            '--enable-keep-src'
+            '--enable-keep-src',
+            # There are hard-coded paths that make the build process fail if
+            # the target prefix is not the configure directory
+            '--prefix={0}'.format(self.stage.source_path),
+            # Double precision
+            *self.enable_or_disable('dp'),
+            # Application profiling
+            *self.enable_or_disable('time'),
+            *self.enable_or_disable('memory'),
+            # MPI + threading
+            *self.enable_or_disable('mpi'),
+            *self.enable_or_disable('openmp'),
+            # Other dependencies
+            '--with-libxc-path={0}'.format(spec['libxc'].prefix),
         ]
 
-        # There are hard-coded paths that make the build process fail if the
-        # target prefix is not the configure directory
-        args.append('--prefix={0}'.format(self.stage.source_path))
-        if '@:4.5.3' in spec:
-            if '%gcc@9.0.0:' in spec:
-                args.append('FCFLAGS=-fallow-argument-mismatch')
+        # gfortran 10 turned argument mismatches into errors and added
+        # -fallow-argument-mismatch to downgrade them
+        if spec.satisfies('@:4.5.3 %gcc@10:'):
+            args.append('FCFLAGS=-fallow-argument-mismatch')
 
-        # Double precision
-        args.extend(self.enable_or_disable('dp'))
+        return (args + self._blas_args() + self._scalapack_args() +
+                self._io_args() + self._gpu_args())
 
-        # Application profiling
-        args.extend(self.enable_or_disable('time'))
-        args.extend(self.enable_or_disable('memory'))
-
-        # MPI + threading
-        args.extend(self.enable_or_disable('mpi'))
-        args.extend(self.enable_or_disable('openmp'))
+    def _blas_args(self):
+        """Configure options for BLAS/LAPACK and FFT."""
+        spec = self.spec
+        args = []
 
         # MKL
-        mkl_lines = {
-            'intel': '-lmkl_gf_lp64 -lmkl_sequential -lmkl_core',
-            'intel_thr': '-lmkl_intel_lp64 -lmkl_intel_thread -lmkl_core -liomp5',
-            'oneapi': '-lmkl_gf_lp64 -lmkl_sequential -lmkl_core',
-            'oneapi_thr': '-lmkl_intel_lp64 -lmkl_intel_thread -lmkl_core -liomp5',
-            'gcc': '-Wl,--no-as-needed -lmkl_gf_lp64 -lmkl_sequential -lmkl_core',
-            'gcc_thr': '-lmkl_gf_lp64 -lmkl_gnu_thread -lmkl_core -lgomp',
-            'nvhpc': '-lmkl_intel_lp64 -lmkl_sequential -lmkl_core',
-            'nvhpc_thr': '-lmkl_intel_lp64 -lmkl_pgi_thread -lmkl_core -pgf90libs -mp',
-        }
-        mkl_line=''
+        mkl_libs = None
         if 'mkl' in spec:
-            mkl_line = "-L{0}/lib/intel64 ".format(env['MKLROOT'])
-            if '%intel' in spec or '%oneapi' in spec:
-                comp = "intel"
-            elif '%gcc' in spec:
-                comp = "gnu"
-            elif '%nvhpc' in spec:
-                comp = "pgi"
-            if "+openmp" in spec:
-                comp += "_thr"
-            mkl_line += mkl_lines[comp]
-            mkl_line += ' -lpthread -lm -ldl'
+            mkl_libs = _MKL_LIBS.get((self._compiler_family(), '+openmp' in spec))
+        if mkl_libs:
+            mkl_line = '{0} {1} -lpthread -lm -ldl'.format(spec['blas'].libs.search_flags, mkl_libs)
 
             # BLAS/LAPACK
-            args.append(
-                '--with-blas-libs={0} --with-lapack-libs={0}'.format(mkl_line)
-                )
+            args.extend([
+                '--with-blas-libs={0}'.format(mkl_line),
+                '--with-lapack-libs={0}'.format(mkl_line),
+            ])
             # FFT
             args.extend([
                 '--with-fft-libs={0}'.format(mkl_line),
@@ -412,21 +536,21 @@ class Yambo(AutotoolsPackage,CudaPackage,ROCmPackage):
             # FFT
             args.append('--with-fft-path={0}'.format(spec['fftw-api'].prefix))
 
+        return args
+
+    def _scalapack_args(self):
+        """Configure options for the parallel linear algebra: ScaLAPACK and SLEPc."""
+        spec = self.spec
+        args = []
+
         # ScaLAPACK
+        # MKL's ScaLAPACK libs already list the BLACS matching the MPI provider
         if '+scalapack' in spec:
-            args.append('--enable-par-linalg')
-            if 'mkl' in spec and 'intel' in spec['mpi'].name and '^netlib-scalapack' not in spec:
-                args.extend([
-                    '--with-blacs-libs=-L{0}/lib/intel64 '
-                    '-lmkl_blacs_intelmpi_lp64'.format(env['MKLROOT']),
-                    '--with-scalapack-libs=-L{0}/lib/intel64 '
-                    '-lmkl_scalapack_lp64'.format(env['MKLROOT']),
-                ])
-            else:
-                args.extend([
-                    '--with-blacs-libs={0}'.format(spec['scalapack'].libs),
-                    '--with-scalapack-libs={0}'.format(spec['scalapack'].libs),
-                ])
+            args.extend([
+                '--enable-par-linalg',
+                '--with-blacs-libs={0}'.format(spec['scalapack'].libs),
+                '--with-scalapack-libs={0}'.format(spec['scalapack'].libs),
+            ])
 
         # PETSc + SLEPc
         if '+slepc' in spec:
@@ -436,37 +560,43 @@ class Yambo(AutotoolsPackage,CudaPackage,ROCmPackage):
                 '--with-slepc-path={0}'.format(spec['slepc'].prefix),
             ])
 
-        # I/O
-        args.extend([
+        return args
+
+    def _io_args(self):
+        """Configure options for NetCDF and (parallel) HDF5."""
+        spec = self.spec
+        return [
             '--with-netcdf-path={0}'.format(spec['netcdf-c'].prefix),
             '--with-netcdff-path={0}'.format(spec['netcdf-fortran'].prefix),
-            '--with-hdf5-path={0}'.format(spec['hdf5'].prefix)
-        ])
+            '--with-hdf5-path={0}'.format(spec['hdf5'].prefix),
+            *self.enable_or_disable('parallel_io'),
+        ]
 
-        # Parallel I/O
-        if '@4.4.0:' in spec:
-            args.extend(self.enable_or_disable('parallel_io'))
+    def _gpu_args(self):
+        """Configure options for the GPU backends and GPU libraries."""
+        spec = self.spec
+        develop_gpu = spec.satisfies('@develop-gpu')
+        args = []
 
-        # Other dependencies
-        args.append('--with-libxc-path={0}'.format(spec['libxc'].prefix))
-        if '@develop-gpu' in spec:
+        if develop_gpu:
             args.append('--with-devxlib-path={0}'.format(spec['devicexlib'].home))
-
-        # GPU
         if '+cuda-fortran' in spec: args.append('--enable-cuda-fortran')
         if '+openacc' in spec: args.append('--enable-openacc')
         if '+openmp5' in spec: args.append('--enable-openmp5')
         if '+cuda' in spec:
-            if '@develop-gpu' in spec:
-                args.append('--with-cuda-cc={0}'.format(*spec.variants['cuda_arch'].value))
-                args.append('--with-cuda-runtime={0}.{1}'.format(*spec['cuda'].version))
-                args.append('--with-cuda-path={0}'.format(spec['cuda'].prefix))
+            cuda = spec['cuda']
+            cuda_arch = spec.variants['cuda_arch'].value
+            cuda_runtime = cuda.version.up_to(2)
+            if develop_gpu:
+                # Only a single compute capability is accepted here
+                args.append('--with-cuda-cc={0}'.format(cuda_arch[0]))
+                args.append('--with-cuda-runtime={0}'.format(cuda_runtime))
+                args.append('--with-cuda-path={0}'.format(cuda.prefix))
             else:
-                enable_cuda = '--enable-cuda=cuda{0}.{1}'.format(*spec['cuda'].version)
-                enable_cuda += ',cc{0}'.format(*spec.variants['cuda_arch'].value)
-                args.append(enable_cuda)
+                cuda_ccs = ','.join('cc{0}'.format(cc) for cc in cuda_arch)
+                args.append('--enable-cuda=cuda{0},{1}'.format(cuda_runtime, cuda_ccs))
             if '+nvtx' in spec:
-                args.append('--enable-nvtx={0}'.format(spec['cuda'].home))
+                args.append('--enable-nvtx={0}'.format(cuda.home))
         if '+magma' in spec:
             args.append('--enable-magma-linalg')
             args.append('--with-magma-path={0}'.format(spec['magma'].prefix))
@@ -474,5 +604,24 @@ class Yambo(AutotoolsPackage,CudaPackage,ROCmPackage):
         return args
 
     def install(self, spec, prefix):
-        # 'install' target is not present
+        # 'install' target is not present: hard-link the binaries into the
+        # prefix when the stage looks to be on the same filesystem, copy them
+        # otherwise or if linking fails (bind mounts, filesets, no hard links)
+        mkdirp(prefix)
+        if os.stat('bin').st_dev == os.stat(prefix).st_dev:
+            try:
+                shutil.copytree('bin', prefix.bin, copy_function=os.link)
+                return
+            except OSError:
+                # Drop partial links, copying onto them raises SameFileError
+                shutil.rmtree(prefix.bin, ignore_errors=True)
         install_tree('bin', prefix.bin)
+
+    @run_after('install')
+    def install_mpiio_hints(self):
+        if not self.romio_hints:
+            return
+        mkdirp(self.prefix.etc)
+        with open(self.romio_hints, 'w') as f:
+            for key, value in _MPIIO_HINTS[self.spec.variants['mpiio_hints'].value]:
+                f.write('{0} {1}\n'.format(key, value))